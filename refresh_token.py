@@ -2,25 +2,51 @@
 """
 Schwab API Authentication with schwab-py
 
-Run for initial auth: python schwab_auth.py --auth
-Run for refresh/check: python schwab_auth.py --refresh
+Run for initial auth: python refresh_token.py --auth
+Run for refresh/check: python refresh_token.py --refresh
+Run for status only:   python refresh_token.py --check
 """
 
+import os
 import sys
+from functools import lru_cache
 from pathlib import Path
-from schwab.auth import client_from_manual_flow, client_from_token_file
+from schwab.auth import TOKEN_ENDPOINT, client_from_access_functions, client_from_manual_flow
 from schwab.client import Client
+import httpx
 import json
 import time
 from datetime import datetime
 
+try:
+    import orjson
+except ImportError:  # Optional: stdlib json is used when orjson is absent
+    orjson = None
+
+_parse_json = orjson.loads if orjson else json.loads
+
+def _dump_json(data, pretty=False):
+    """Serialize to JSON bytes, compact unless pretty is set"""
+    if orjson:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 if pretty else None)
+    if pretty:
+        return json.dumps(data, indent=2).encode()
+    return json.dumps(data, separators=(',', ':')).encode()
+
 # Configuration
 SCHWAB_TOKEN_FILE = "src-tauri/schwab_tokens.json"  # Single token file
 ENV_FILE = ".env"
 CALLBACK_URL = "https://127.0.0.1:8182"
+# Refresh this long before the access token actually expires; the expiry
+# time is a hard deadline, not a target. Long-lived tokens use 20% of
+# their lifetime instead when that is larger.
+REFRESH_SKEW_SECONDS = 300
+RETRY_DELAYS = (0, 2, 5)  # Seconds to wait before each attempt
+RETRY_STATUS_CODES = frozenset((500, 502, 503, 504))
 
+@lru_cache(maxsize=1)
 def load_config():
-    """Load API credentials from .env file"""
+    """Load API credentials from .env file (parsed once per process)"""
     config = {}
     if Path(ENV_FILE).exists():
         with open(ENV_FILE, 'r') as f:
@@ -32,64 +58,143 @@ def load_config():
         print(f"❌ {ENV_FILE} not found")
     return config
 
-def save_tokens(token_data):
-    """Save token data to the single token file"""
+def save_tokens(token_data, pretty=False):
+    """Atomically save token data to the single token file"""
+    tmp_file = SCHWAB_TOKEN_FILE + ".tmp"
     try:
-        with open(SCHWAB_TOKEN_FILE, 'w') as f:
-            json.dump(token_data, f, indent=2)
+        # Write aside and rename so a crash never leaves a truncated token file.
+        # Owner-only mode, since the rename replaces the token file's permissions.
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_dump_json(token_data, pretty))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, SCHWAB_TOKEN_FILE)
         print(f"✅ Tokens saved to {SCHWAB_TOKEN_FILE}")
         return True
     except Exception as e:
         print(f"❌ Error saving tokens: {e}")
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            pass
         return False
 
+def _read_json(path):
+    """Parse a JSON file"""
+    with open(path, 'rb') as f:
+        return _parse_json(f.read())
+
+@lru_cache(maxsize=4)
+def _load_json(path, mtime_ns):
+    """Parse a JSON file; mtime_ns is part of the cache key only"""
+    return _read_json(path)
+
+def load_tokens(token_file):
+    """Load token data, reusing the last parse while the file is unchanged"""
+    return _load_json(token_file, os.stat(token_file).st_mtime_ns)
+
+def _write_token_hook(token, *args, **kwargs):
+    """schwab-py token_write_func; extra refresh arguments are ignored"""
+    save_tokens(token)
+
+@lru_cache(maxsize=64)
+def _expires_str_to_ts(value):
+    """Convert an ISO 8601 or integer expires_at string to a timestamp"""
+    try:
+        # Handle ISO 8601 datetime strings (e.g., "2025-10-08T00:35:03.531020Z")
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+    except ValueError:
+        # Try parsing as integer string
+        return int(value)
+
+_EXPIRES_AT_PARSERS = {str: _expires_str_to_ts, int: float, float: float}
+
 def check_token_status(token_file):
     """Check token status from token file"""
     if not Path(token_file).exists():
         print(f"❌ Token file {token_file} not found")
         return False
-    with open(token_file, 'r') as f:
-        data = json.load(f)
-    
+    data = load_tokens(token_file)
+    if not isinstance(data, dict):
+        print("❌ No expires_at found in token file")
+        return False
+
     # Handle both old and new token formats
+    token = data.get('token')
+    if not isinstance(token, dict):
+        token = {}
     if 'expires_at' in data:
         # Old format: expires_at at root level
         expires_at = data['expires_at']
-    elif 'token' in data and 'expires_at' in data['token']:
+    elif 'expires_at' in token:
         # New format: expires_at in token object
-        expires_at = data['token']['expires_at']
+        expires_at = token['expires_at']
     else:
         print("❌ No expires_at found in token file")
         return False
 
+    lifetime = token.get('expires_in') or data.get('expires_in')
+    try:
+        # expires_in may be stored as a number or a numeric string
+        skew = max(REFRESH_SKEW_SECONDS, 0.2 * float(lifetime))
+    except (TypeError, ValueError):
+        skew = REFRESH_SKEW_SECONDS
+
     # Convert expires_at to timestamp
-    if isinstance(expires_at, str):
-        # Handle ISO 8601 datetime strings (e.g., "2025-10-08T00:35:03.531020Z")
-        try:
-            expires_dt = datetime.fromisoformat(expires_at.replace('Z', '+00:00'))
-            expires_at = expires_dt.timestamp()
-        except ValueError:
-            # Try parsing as integer string
-            try:
-                expires_at = int(expires_at)
-            except ValueError:
-                print(f"❌ Invalid expires_at format: {expires_at}")
-                return False
+    parse = _EXPIRES_AT_PARSERS.get(type(expires_at))
+    try:
+        if parse is None:
+            raise ValueError
+        expires_at = parse(expires_at)
+    except ValueError:
+        print(f"❌ Invalid expires_at format: {expires_at}")
+        return False
 
     now = time.time()
     print("📊 Token Status:")
     print(f"   Expires:  {datetime.fromtimestamp(expires_at)}")
     print(f"   Current:  {datetime.fromtimestamp(now)}")
-    is_expired = expires_at < now
     time_left = expires_at - now
-    if is_expired:
+    is_expired = time_left < skew
+    if time_left < 0:
         print(f"❌ Token expired {abs(time_left):.0f} seconds ago")
+    elif is_expired:
+        print(f"⚠️ Token expires in {time_left:.0f} seconds, inside the refresh window")
     else:
         hours_left = time_left / 3600
         print(f"✅ Token valid for {hours_left:.1f} more hours")
     return not is_expired
 
+def with_retry(call):
+    """Run call(), backing off on network errors and 5xx responses"""
+    for attempt, delay in enumerate(RETRY_DELAYS, 1):
+        time.sleep(delay)
+        last_attempt = attempt == len(RETRY_DELAYS)
+        try:
+            result = call()
+        except httpx.TransportError as e:
+            if last_attempt:
+                raise
+            print(f"⚠️ Attempt {attempt} failed ({e}), retrying...")
+            continue
+        except httpx.HTTPStatusError as e:
+            # The OAuth refresh raises on error responses instead of returning them
+            if last_attempt or e.response.status_code not in RETRY_STATUS_CODES:
+                raise
+            print(f"⚠️ Attempt {attempt} returned {e.response.status_code}, retrying...")
+            continue
+        status = getattr(result, 'status_code', None)
+        if last_attempt or status not in RETRY_STATUS_CODES:
+            return result
+        print(f"⚠️ Attempt {attempt} returned {status}, retrying...")
+
 def main():
+    mode = sys.argv[1] if len(sys.argv) > 1 else None
+    if mode == '--check':
+        # Status only: no credentials or network access needed
+        sys.exit(0 if check_token_status(SCHWAB_TOKEN_FILE) else 1)
+
     config = load_config()
     api_key = config.get('SCHWAB_API_KEY')
     app_secret = config.get('SCHWAB_APP_SECRET')
@@ -98,7 +203,7 @@ def main():
         print("❌ Missing SCHWAB_API_KEY or SCHWAB_APP_SECRET in .env file")
         sys.exit(1)
 
-    if len(sys.argv) > 1 and sys.argv[1] == '--auth':
+    if mode == '--auth':
         # Initial authentication
         print("🔐 Starting initial authentication...")
         print("\n" + "="*60)
@@ -109,7 +214,7 @@ def main():
             api_key, app_secret, CALLBACK_URL, token_path=SCHWAB_TOKEN_FILE
         )
         print("✅ Initial authentication complete!")
-    elif len(sys.argv) > 1 and sys.argv[1] == '--refresh':
+    elif mode == '--refresh':
         # Load and refresh if needed
         print("🔍 Checking token status...")
         if check_token_status(SCHWAB_TOKEN_FILE):
@@ -117,9 +222,19 @@ def main():
         else:
             print("\n🔄 Loading client (auto-refreshes if refresh token valid)...")
             try:
-                client = client_from_token_file(SCHWAB_TOKEN_FILE, api_key, app_secret)
+                # Route schwab-py's token writes through save_tokens() so a
+                # crash mid-refresh cannot truncate the token file. Reads get
+                # a fresh parse, since schwab-py may mutate what it is given.
+                client = client_from_access_functions(
+                    api_key, app_secret,
+                    token_read_func=lambda: _read_json(SCHWAB_TOKEN_FILE),
+                    token_write_func=_write_token_hook,
+                )
+                # The client only refreshes on its own once the token has
+                # actually expired, so force it inside the refresh window
+                with_retry(lambda: client.session.refresh_token(TOKEN_ENDPOINT))
                 # Test with a simple API call
-                response = client.get_account_numbers()
+                response = with_retry(client.get_account_numbers)
                 if response.status_code == 200:
                     print("✅ Refresh successful! API call works.")
                 else:
@@ -129,7 +244,7 @@ def main():
                 print(f"❌ Error loading client: {e}")
                 print("ℹ️ Run with --auth to re-authenticate.")
     else:
-        print("Usage: python refresh_token.py [--auth | --refresh]")
+        print("Usage: python refresh_token.py [--auth | --refresh | --check]")
         sys.exit(1)
 
 if __name__ == "__main__":